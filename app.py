@@ -1,44 +1,223 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, send_from_directory, abort
+from werkzeug.security import safe_join
 from yt_dlp import YoutubeDL
+from yt_dlp.utils import sanitize_filename
 import re
 import os
 import time
 import uuid
 import threading
 import logging
-from urllib.parse import urlparse
+import functools
+import copy
+import queue
+import contextlib
+import mimetypes
+import heapq
+import hmac
+import hashlib
+import json
+import base64
+import shutil
+from urllib.parse import quote, urlsplit
 
 # --- App Configuration ---
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['UPLOAD_FOLDER'] = 'static/downloads'
+# Signs preview info_tokens, so it must not be a value committed to the repo. Without the env var
+# each process gets its own random key and tokens from other instances just fall back to extraction.
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or os.urandom(32).hex()
+# Outside static/ so downloads are only reachable through /serve. Absolute, so file helpers and
+# send_from_directory (which resolves relative paths against root_path) agree on the location.
+app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'downloads')
 app.config['MAX_FILE_AGE_SECONDS'] = 60  # CHANGED: Set back to 60 seconds as requested
-app.config['CLEANUP_INTERVAL_SECONDS'] = 30 # NEW: Run cleanup every 30 seconds for faster deletion
+app.config['REQUEST_CLEANUP_INTERVAL_SECONDS'] = 3600 # Minimum gap between full folder sweeps for files not tracked in-process
+app.config['INFO_CACHE_TTL_SECONDS'] = 30 # How long extracted video info is reused between /preview and /download
+app.config['INFO_CACHE_MAX_ENTRIES'] = 512
+app.config['SERVE_MAX_AGE_SECONDS'] = 30 # Cache-Control max-age for /serve responses
+app.config['X_ACCEL_REDIRECT_PREFIX'] = None # e.g. '/internal/' to let nginx send files instead of Flask
+app.config['INFO_TOKEN_MAX_AGE_SECONDS'] = 60 # How long a /preview info_token lets /download skip extraction
+app.config['MAX_CONCURRENT_DOWNLOADS'] = 8 # Per-process cap on downloads running at once
+app.config['DOWNLOAD_SLOT_WAIT_SECONDS'] = 30 # How long /download waits for a free slot before answering 503
+app.config['YDL_POOL_SIZE'] = 4 # Idle YoutubeDL instances kept per kind for reuse across requests
 
 # --- Logging Configuration ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Characters that are not allowed in filenames (including control characters), stripped in a
+# single C-level pass.
+_FN_TRANSLATE = str.maketrans("", "", '\\/*?:"<>|' + ''.join(map(chr, range(32))) + '\x7f')
+
+# Limits on what a preview info_token may point /download at.
+_TOKEN_MEDIA_HOST_SUFFIXES = ('.cdninstagram.com', '.fbcdn.net')
+_TOKEN_MEDIA_EXTS = frozenset({'mp4', 'jpg', 'webp'})
+_MAX_TITLE_CHARS = 100
+
+# Instagram URL check: http(s) scheme, then instagram.com or a subdomain as the host. The host part
+# stops at any of / ? # \ so a fragment or query can't smuggle in the domain.
+_IG_URL_RE = re.compile(r'^https?://(?:[^/?#\\]*\.)?instagram\.com(?::\d+)?/', re.IGNORECASE)
+
+# Single-slot cache of the last validated URL, checked before the LRU.
+# Stored as one tuple so concurrent requests always see a matching pair.
+_last_url_check = (None, False)
+
+# Timestamp of the last cleanup triggered from a request, so bursts don't rescan the folder.
+_last_cleanup_ts = 0.0
+_cleanup_lock = threading.Lock()
+
+# Files this process downloaded, as a min-heap of (expires_at, filename).
+# _known_files maps the same filenames to their creation time so folder sweeps can skip them.
+_expiry_heap = []
+_known_files = {}
+_heap_lock = threading.Lock()
+
+# Expired downloads whose unlink failed; /serve refuses them until a folder sweep removes them.
+_expired_files = set()
+
+# Pre-rendered HTML for the parameterless pages, filled by prerender_pages().
+_STATIC_PAGES = {}
+
+# Buffer size for streaming direct media URLs to disk.
+_COPY_BUFSIZE = 1024 * 1024
+
+# Pre-serialized body for a finished download; only url, title and expiry vary.
+_DL_OK_TMPL = '{"success":true,"url":"/serve/%s","title":%s,"expires_in_seconds":%d}'
+
+# Limits how many /download requests run a download at the same time.
+_download_slots = threading.BoundedSemaphore(app.config['MAX_CONCURRENT_DOWNLOADS'])
+
+# Whether cleanup can scan and unlink relative to an open directory fd (POSIX only).
+_CLEANUP_USE_DIR_FD = (
+    hasattr(os, 'O_DIRECTORY') and os.unlink in os.supports_dir_fd and os.scandir in os.supports_fd
+)
+
+# Extracted video info keyed by URL: url -> (expires_at, info).
+_info_cache = {}
+_info_cache_lock = threading.Lock()
+
+# YoutubeDL instances are costly to build and not thread-safe, so idle ones are pooled per kind.
+# Each instance also holds its own HTTP session (pooled when yt-dlp uses its Requests handler,
+# hence requests in requirements.txt), so reusing it keeps connections alive.
+# Pooled instances are never reconfigured: the per-request id reaches the output template
+# through the info dict's download_id field instead.
+_YDL_OPTS = {
+    'info': {'format': 'best', 'quiet': True, 'no_warnings': True, 'skip_download': True,
+             'socket_timeout': 10},
+    # buffersize only sets the starting block size. yt-dlp still grows it (up to 4 MB) on fast
+    # links, but starts at 1 MB rather than 1 KB.
+    'download': {'format': 'best', 'quiet': True, 'no_warnings': True,
+                 'buffersize': 1 << 20, 'socket_timeout': 10,
+                 'outtmpl': os.path.join(app.config['UPLOAD_FOLDER'], 'video_%(download_id)s_%(title)s.%(ext)s')},
+}
+_ydl_pools = {kind: queue.LifoQueue(maxsize=app.config['YDL_POOL_SIZE']) for kind in _YDL_OPTS}
+
 # --- Helper Functions ---
 def setup_app():
-    """Ensure necessary folders and background tasks are set up."""
+    """Ensure necessary folders are set up and clear files left by a previous run."""
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    
-    # NEW: Start the background cleanup task as a daemon thread
-    cleanup_thread = threading.Thread(target=background_cleanup_task, daemon=True)
-    cleanup_thread.start()
-    logging.info(f"Background cleanup task started. Will run every {app.config['CLEANUP_INTERVAL_SECONDS']} seconds.")
+    cleanup_old_files()
 
 def clean_filename(filename):
     """Remove invalid characters from filename."""
-    return re.sub(r'[\\/*?:"<>|]', "", filename)
+    return filename.translate(_FN_TRANSLATE)
 
 def is_valid_url(url):
     """Validate URL for Instagram."""
+    global _last_url_check
+    if not isinstance(url, str):
+        return False
+    last_url, last_ok = _last_url_check
+    if url == last_url:
+        return last_ok
+    ok = _is_valid_url_cached(url)
+    _last_url_check = (url, ok)
+    return ok
+
+@functools.lru_cache(maxsize=2048)
+def _is_valid_url_cached(url):
+    """Match the URL against _IG_URL_RE; results are cached per URL string."""
+    return _IG_URL_RE.match(url) is not None
+
+@contextlib.contextmanager
+def pooled_ydl(kind):
+    """Borrow a YoutubeDL instance of the given kind, creating one if none is idle."""
+    pool = _ydl_pools[kind]
+    try:
+        ydl = pool.get_nowait()
+    except queue.Empty:
+        # YoutubeDL keeps the dict it is given, so each instance needs its own copy.
+        ydl = YoutubeDL(copy.deepcopy(_YDL_OPTS[kind]))
+    try:
+        yield ydl
+    finally:
+        try:
+            pool.put_nowait(ydl)
+        except queue.Full:
+            ydl.close()
+
+def get_info(url):
+    """Return yt-dlp info for a URL, reusing a recent extraction if available.
+
+    The returned dict is shared with the cache and must not be mutated.
+    """
+    now = time.time()
+    with _info_cache_lock:
+        entry = _info_cache.get(url)
+    if entry and entry[0] > now:
+        return entry[1]
+
+    with pooled_ydl('info') as ydl:
+        info = ydl.extract_info(url, download=False)
+
+    with _info_cache_lock:
+        if len(_info_cache) >= app.config['INFO_CACHE_MAX_ENTRIES']:
+            for key in [k for k, (expires_at, _) in _info_cache.items() if expires_at <= now]:
+                del _info_cache[key]
+            if len(_info_cache) >= app.config['INFO_CACHE_MAX_ENTRIES']:
+                del _info_cache[next(iter(_info_cache))]
+        _info_cache[url] = (now + app.config['INFO_CACHE_TTL_SECONDS'], info)
+    return info
+
+def sign_info(url, info):
+    """Return a signed token carrying the preview info /download needs to skip extraction."""
+    payload = json.dumps({
+        'url': url,
+        'ext': info.get('ext') or 'mp4',
+        'title': info.get('title') or 'video',
+        'direct_url': info.get('url', ''),
+        'ts': time.time(),
+    }, separators=(',', ':')).encode()
+    signature = hmac.new(app.config['SECRET_KEY'].encode(), payload, hashlib.sha256).hexdigest()
+    return f"{base64.urlsafe_b64encode(payload).decode()}.{signature}"
+
+def load_info_token(token, url):
+    """Return the payload of a valid, fresh info_token for url, or None."""
+    if not isinstance(token, str) or '.' not in token:
+        return None
+    encoded, signature = token.rsplit('.', 1)
+    try:
+        payload = base64.urlsafe_b64decode(encoded.encode())
+    except ValueError:
+        return None
+    expected = hmac.new(app.config['SECRET_KEY'].encode(), payload, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(signature.encode(), expected.encode()):
+        return None
+    info = json.loads(payload)
+    if info.get('url') != url or time.time() - info.get('ts', 0) > app.config['INFO_TOKEN_MAX_AGE_SECONDS']:
+        return None
+    if info.get('ext') not in _TOKEN_MEDIA_EXTS or not is_media_cdn_url(info.get('direct_url')):
+        return None
+    return info
+
+def is_media_cdn_url(direct_url):
+    """Check that a direct media URL is https on an Instagram/Facebook CDN host."""
+    if not isinstance(direct_url, str):
+        return False
     try:
-        parsed = urlparse(url)
-        return all([parsed.scheme, parsed.netloc]) and 'instagram.com' in parsed.netloc
-    except (ValueError, AttributeError):
+        parts = urlsplit(direct_url)
+    except ValueError:
         return False
+    host = parts.hostname or ''
+    return parts.scheme == 'https' and host.endswith(_TOKEN_MEDIA_HOST_SUFFIXES)
 
 def cleanup_old_files():
     """Delete files in UPLOAD_FOLDER older than MAX_FILE_AGE."""
@@ -49,38 +228,145 @@ def cleanup_old_files():
         
         logging.info("Running scheduled file cleanup...")
         deleted_count = 0
-        for filename in os.listdir(folder):
-            file_path = os.path.join(folder, filename)
-            if os.path.isfile(file_path):
-                if (now - os.path.getmtime(file_path)) > max_age:
-                    try:
-                        os.remove(file_path)
-                        logging.info(f"Deleted old file: {filename}")
-                        deleted_count += 1
-                    except Exception as e:
-                        logging.error(f"Error deleting file {file_path}: {e}")
+        # scandir yields the entry type with the listing, so only one stat per file is needed.
+        # Where supported, list, stat and unlink relative to one open directory fd so the
+        # kernel resolves the folder path once instead of once per file.
+        dir_fd = None
+        if _CLEANUP_USE_DIR_FD:
+            dir_fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            with os.scandir(folder if dir_fd is None else dir_fd) as entries:
+                for entry in entries:
+                    # Files this process created are expired via the heap; no need to stat them.
+                    if entry.name in _known_files:
+                        continue
+                    if entry.is_file(follow_symlinks=False) and (now - entry.stat(follow_symlinks=False).st_mtime) > max_age:
+                        try:
+                            if dir_fd is None:
+                                os.unlink(entry.path)
+                            else:
+                                os.unlink(entry.name, dir_fd=dir_fd)
+                            _expired_files.discard(entry.name)
+                            logging.info(f"Deleted old file: {entry.name}")
+                            deleted_count += 1
+                        except Exception as e:
+                            logging.error(f"Error deleting file {entry.name}: {e}")
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
         logging.info(f"Cleanup finished. Deleted {deleted_count} file(s).")
     except Exception as e:
         logging.error(f"An error occurred during the cleanup process: {e}")
 
-def background_cleanup_task():
-    """NEW: This function runs in the background to periodically clean up old files."""
-    while True:
-        time.sleep(app.config['CLEANUP_INTERVAL_SECONDS'])
-        cleanup_old_files()
+def maybe_cleanup_old_files():
+    """Run cleanup_old_files at most once per REQUEST_CLEANUP_INTERVAL_SECONDS."""
+    global _last_cleanup_ts
+    interval = app.config['REQUEST_CLEANUP_INTERVAL_SECONDS']
+    if time.time() - _last_cleanup_ts <= interval:
+        return
+    with _cleanup_lock:
+        now = time.time()
+        if now - _last_cleanup_ts > interval:
+            cleanup_old_files()
+            _last_cleanup_ts = now
+
+def track_download(filename):
+    """Schedule a file written by /download for deletion after MAX_FILE_AGE."""
+    now = time.time()
+    with _heap_lock:
+        _known_files[filename] = now
+        heapq.heappush(_expiry_heap, (now + app.config['MAX_FILE_AGE_SECONDS'], filename))
+
+def expire_downloads():
+    """Delete tracked downloads whose expiry has passed; only expired entries are touched."""
+    now = time.time()
+    folder = app.config['UPLOAD_FOLDER']
+    expired = []
+    with _heap_lock:
+        while _expiry_heap and _expiry_heap[0][0] <= now:
+            filename = heapq.heappop(_expiry_heap)[1]
+            _known_files.pop(filename, None)
+            expired.append(filename)
+    for filename in expired:
+        try:
+            os.unlink(os.path.join(folder, filename))
+            logging.info(f"Deleted expired file: {filename}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            _expired_files.add(filename)
+            logging.error(f"Error deleting file {filename}: {e}")
+
+def _fetch_direct(direct_url, filepath):
+    """Stream a direct media URL to filepath, removing partial output on failure."""
+    try:
+        # Go through a pooled YoutubeDL so the fetch reuses its kept-alive CDN connections.
+        with pooled_ydl('download') as ydl, ydl.urlopen(direct_url) as response, open(filepath, 'wb') as f:
+            shutil.copyfileobj(response, f, _COPY_BUFSIZE)
+    except Exception:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(filepath)
+        raise
+
+def _do_download(url, token_info=None):
+    """Download a video into UPLOAD_FOLDER and return the serialized /download response for it."""
+    unique_id = uuid.uuid4().hex[:8]
+    
+    if token_info and token_info.get('direct_url'):
+        # The signed preview info already has the media URL, so skip extraction entirely.
+        title = token_info['title']
+        safe_title = sanitize_filename(clean_filename(title))[:_MAX_TITLE_CHARS] or 'video'
+        filename = f"video_{unique_id}_{safe_title}.{token_info['ext']}"
+        _fetch_direct(token_info['direct_url'], os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    else:
+        # Reuse the info from a preceding /preview instead of extracting it again.
+        info = copy.deepcopy(get_info(url))
+        info['download_id'] = unique_id
+        with pooled_ydl('download') as ydl:
+            info = ydl.process_ie_result(info, download=True)
+            filename = os.path.basename(ydl.prepare_filename(info))
+        title = info.get('title', 'Downloaded Video')
+    track_download(filename)
+    
+    # quote() output never needs JSON escaping; the title goes through json.dumps.
+    # expires_in_seconds is for the frontend timer.
+    return _DL_OK_TMPL % (quote(filename), json.dumps(title), app.config['MAX_FILE_AGE_SECONDS'])
+
+def drop_page_cache(filepath):
+    """Tell the kernel a served file won't be read again so its pages can be evicted."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def prerender_pages():
+    """Render the pages whose context never changes once, so requests skip Jinja."""
+    # A request context lets url_for build the static asset URLs used by the templates.
+    with app.test_request_context('/'):
+        _STATIC_PAGES['index'] = render_template('index.html')
+        _STATIC_PAGES['about'] = render_template('about.html', platform='Instagram')
+        _STATIC_PAGES['downloader'] = render_template('downloader.html', platform='Instagram')
 
 # --- Routes ---
 @app.route('/')
 def home():
-    return render_template('index.html')
+    return _STATIC_PAGES['index']
 
 @app.route('/about')
 def about():
-    return render_template('about.html', platform='Instagram')
+    return _STATIC_PAGES['about']
 
 @app.route('/downloader/instagram')
 def downloader():
-    return render_template('downloader.html', platform='Instagram')
+    return _STATIC_PAGES['downloader']
 
 @app.route('/preview', methods=['POST'])
 def preview():
@@ -91,16 +377,15 @@ def preview():
         return jsonify({'error': 'Invalid Instagram URL'}), 400
     
     try:
-        ydl_opts = {'format': 'best', 'quiet': True, 'no_warnings': True}
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return jsonify({
-                'success': True,
-                'title': info.get('title', 'Video Preview'),
-                'thumbnail': info.get('thumbnail', ''),
-                'duration': info.get('duration', 0),
-                'url': info.get('url', '')
-            })
+        info = get_info(url)
+        return jsonify({
+            'success': True,
+            'title': info.get('title', 'Video Preview'),
+            'thumbnail': info.get('thumbnail', ''),
+            'duration': info.get('duration', 0),
+            'url': info.get('url', ''),
+            'info_token': sign_info(url, info)
+        })
     except Exception as e:
         logging.error(f"Error in /preview for URL {url}: {e}")
         return jsonify({'error': 'Could not fetch video preview.'}), 500
@@ -113,28 +398,48 @@ def download():
     if not url or not is_valid_url(url):
         return jsonify({'error': 'Invalid Instagram URL'}), 400
     
+    expire_downloads()
+    maybe_cleanup_old_files()
+    
+    token_info = load_info_token(data.get('info_token'), url)
+    if not _download_slots.acquire(timeout=app.config['DOWNLOAD_SLOT_WAIT_SECONDS']):
+        return jsonify({'error': 'The server is busy. Please try again shortly.'}), 503
     try:
-        unique_id = str(uuid.uuid4())[:8]
-        ydl_opts = {
-            'format': 'best',
-            'outtmpl': os.path.join(app.config['UPLOAD_FOLDER'], f'video_{unique_id}_%(title)s.%(ext)s'),
-            'quiet': True,
-            'no_warnings': True,
-        }
-        
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = os.path.basename(ydl.prepare_filename(info))
-            
-            return jsonify({
-                'success': True,
-                'url': f'/static/downloads/{filename}',
-                'title': info.get('title', 'Downloaded Video'),
-                'expires_in_seconds': app.config['MAX_FILE_AGE_SECONDS'] # For frontend timer
-            })
+        body = _do_download(url, token_info)
     except Exception as e:
         logging.error(f"Error in /download for URL {url}: {e}")
         return jsonify({'error': 'Could not process the video download.'}), 500
+    finally:
+        _download_slots.release()
+    return app.response_class(body, mimetype='application/json')
+
+@app.route('/serve/<filename>')
+def serve_file(filename):
+    """Serve a downloaded file, handing the transfer to nginx when configured."""
+    # Serving is the other frequent entry point, so expiry runs here too, not only on /download.
+    expire_downloads()
+    maybe_cleanup_old_files()
+    if filename in _expired_files:
+        abort(404)
+    
+    prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+    if prefix:
+        if safe_join(app.config['UPLOAD_FOLDER'], filename) is None:
+            abort(404)
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = prefix + quote(filename)
+        return response
+    # conditional=True enables Range/304 handling; the body goes through wsgi.file_wrapper (sendfile).
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, conditional=True,
+                                   etag=True, max_age=app.config['SERVE_MAX_AGE_SECONDS'])
+    # Each file is served about once and deleted soon after, so don't let it crowd the page cache.
+    # Range (206) responses are skipped: players send several, and later ones would hit the disk.
+    if response.status_code != 206:
+        response.call_on_close(lambda: drop_page_cache(os.path.join(app.config['UPLOAD_FOLDER'], filename)))
+    return response
+
+# Render at import so the first request after a cold start doesn't pay for template compilation.
+prerender_pages()
 
 if __name__ == '__main__':
     setup_app()